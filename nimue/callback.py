@@ -7,10 +7,12 @@ Healthcheck Callbacks
 =====================
 Healthcheck for connection liveness is performed by calling a healthcheck callback function. The default
 is **healthcheck_callback_std**. There's also an included **healthcheck_callback_oracle** for use with
-Oracle. These should suffice for most use-cases, but if something more complex is needed, there are two
+Oracle, and **healthcheck_callback_ping** for drivers whose connections provide a ping() method, which
+checks the connection without running a query. These should suffice for most use-cases, but if something more complex is needed, there are two
 options:
 * The builtin callbacks use the base function **healthcheck_callback_base**, which accepts query as an
-  argument. The user can define their own callback calling this function with a custom query.
+  argument. The user can define their own callback calling this function with a custom query, or build
+  one with **make_healthcheck_callback**.
 * The user can also define a completely custom callback function. It should return False on failure and
   True on success.
 A custom healthcheck callback should follow the signature functionname(conn,dbmodule,logger). Where *conn* is
@@ -19,7 +21,6 @@ the raw connection object to be be checked, *dbmodule* is the database module th
 Nimue passes these parameters when calling the callback.
 """
 
-import contextlib
 import logging
 
 logger = logging.getLogger(__name__)
@@ -40,6 +41,22 @@ def healthcheck_callback_oracle(conn,dbmodule):
   """
   return healthcheck_callback_base(conn,dbmodule,"SELECT 1 FROM DUAL")
 
+def healthcheck_callback_ping(conn,dbmodule):
+  """
+  Healthcheck callback for drivers whose connections have a ping() method, such as cx_Oracle, mysql.connector,
+  mariadb and PyMySQL. Checks liveness with a protocol-level ping rather than executing a query.
+  :param conn: The raw connection being healthchecked.
+  :param dbmodule: The db driver module conn is derived from. Provided for access to driver-specific exceptions.
+  """
+  try:
+    conn.ping()
+  except dbmodule.Error:
+    return False
+  except Exception:
+    logger.exception('Unexpected exception during healthcheck. Connection will be invalidated.')
+    return False
+  return True
+
 def healthcheck_callback_base(conn,dbmodule,query):
   """
   Healthcheck logic the other builtin functions call. Can be used to implement a healthcheck with a custom query.
@@ -52,14 +69,29 @@ def healthcheck_callback_base(conn,dbmodule,query):
       return healthcheck_callback_base(conn,dbmodule,"select * from mytable")
   """
   try:
-    with contextlib.closing(conn.cursor()) as curs:
+    curs=conn.cursor()
+    try:
       curs.execute(query)
       # some drivers don't like closing a cursor with unfetched rows
       curs.fetchall()
+    finally:
+      curs.close()
     conn.rollback()
   except dbmodule.OperationalError:
     return False
-  except:
+  except Exception:
     logger.exception('Unexpected exception during healthcheck. Connection will be invalidated.')
     return False
   return True
+
+def make_healthcheck_callback(query):
+  """
+  Build a healthcheck callback running a custom query through healthcheck_callback_base.
+  :param query: Custom healthcheck query.
+
+  :returns: A healthcheck callback suitable for passing as healthcheck_callback. For example::
+    pool=nimue.NimueConnectionPool(connfunc,healthcheck_callback=make_healthcheck_callback("select * from mytable"))
+  """
+  def healthcheck_callback(conn,dbmodule):
+    return healthcheck_callback_base(conn,dbmodule,query)
+  return healthcheck_callback
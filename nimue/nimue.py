@@ -4,46 +4,74 @@
 Submodule implementing core functionality.  Import "nimue" instead of importing this directly.
 """
 
+import collections
+import concurrent.futures
 import contextlib
 import logging
 import importlib
+import itertools
 import threading
 import time
+import weakref
 
 from . import callback
 from . import error
 
 logger = logging.getLogger(__name__)
 
-class _NimueSubCleanupThread(threading.Thread):
-  def __init__(self,owner):
-    super().__init__(daemon=False)
-    self.owner=owner
-
-  def run(self):
-    self.owner._cleanpool()
+# upper bound on threads used to open initial connections in parallel
+_CONNECT_MAX_WORKERS=8
+# upper bound on threads used to healthcheck free connections in parallel during cleanup
+_HEALTHCHECK_MAX_WORKERS=8
 
 class _NimueCleanupThread(threading.Thread):
   def __init__(self,owner):
     super().__init__(daemon=True)
     self.exitevent=owner._exitevent
-    self.owner=owner
+    # only hold a weak reference, so an unreferenced pool can still be garbage collected
+    self.owner=weakref.ref(owner)
 
   def run(self):
-    while not self.exitevent.wait(timeout=self.owner.cleanup_interval):
-      subthread=_NimueSubCleanupThread(self.owner)
-      subthread.start()
-      subthread.join()
+    while True:
+      owner=self.owner()
+      if owner is None:
+        return
+      cleanup_interval=owner.cleanup_interval
+      # don't keep the pool alive while sleeping
+      del owner
+      if self.exitevent.wait(timeout=cleanup_interval):
+        return
+      owner=self.owner()
+      if owner is None:
+        return
+      # a failed cycle shouldn't stop cleanup for the life of the pool
+      try:
+        owner._cleanpool()
+      except Exception:
+        logger.exception("Unexpected exception during pool cleanup.")
+      del owner
+
+def _isdbmodule(module):
+  # Whether module looks like a DBAPI 2.0 driver module, rather than something else that
+  # happens to have a connect function.
+  return all(hasattr(module,name) for name in ('connect','apilevel','Error','OperationalError'))
+
+def _closepool(exitevent,cleanupthread):
+  # Shut down a pool's cleanup thread. Runs through weakref.finalize, so it must
+  # not hold a reference to the pool itself.
+  exitevent.set()
+  if cleanupthread.is_alive() and cleanupthread is not threading.current_thread():
+    cleanupthread.join()
 
 class NimueConnectionPool:
   """
   Nimue Connection Pool object. An implementation of a database connection pool for DBAPI 2.0 compliant drivers. Allocates
   a configurable number of initial connections, with the ability to increase on-demand up to maximum. Spawns a background
-  thread responsible for cleanup. Can be used as a context manager, which calls the close() method upon exit. This is the
-  recommended usage. It's important to note that the close() method blocks until all connections are returned to the pool,
+  thread responsible for cleanup on the first call to getconnection(). Can be used as a context manager, which calls the close() method upon exit. This is the
+  recommended usage. The close() method does not wait for connections still in use; they are closed as they are returned,
   so it is important not to leak connections, and return them when not in use. Use of context managers is strongly encouraged.
   """
-  def __init__(self,connfunc,connargs=None,connkwargs=None,poolinit=None,poolmin=10,poolmax=20,cleanup_interval=60,idle_timeout=300,healthcheck_on_getconnection=True,healthcheck_callback=callback.healthcheck_callback_std):
+  def __init__(self,connfunc,connargs=None,connkwargs=None,poolinit=None,poolmin=10,poolmax=20,cleanup_interval=60,idle_timeout=300,healthcheck_on_getconnection=True,healthcheck_callback=callback.healthcheck_callback_std,healthcheck_interval=30):
     """
     :param connfunc: (required) A callable that returns a DBAPI 2.0 compliant Connection object.
     :param connargs: Iterable list of args to be passed to connfunc.
@@ -54,6 +82,7 @@ class NimueConnectionPool:
     :param cleanup_interval: Wakeup interval for cleanup thread, in seconds. Defaults to 60. Must be greater than 0.
     :param idle_timeout: Idle timeout in seconds, after which idle connections are eligible for cleanup. Defaults to 300. Cannot be less than 0.
     :healthcheck_on_getconnection: If True, perform a healthcheck on getconnection from the pool. If the check fails, the connection is discarded from the pool, and the method continues trying connections until a healthy one can be returned (or until timeout occurs, if set). Defaults to True.
+    :param healthcheck_interval: Time in seconds since a free connection was last used or healthchecked, before the cleanup thread healthchecks it again. Connections used more recently are assumed healthy. Defaults to 30. Cannot be less than 0.
 
     :returns: Returns a NimueConnectionPool object.
 
@@ -63,10 +92,19 @@ class NimueConnectionPool:
     # will cause cascading exceptions on failure
     self._lock=threading.Condition()
     self._exitevent=threading.Event()
-    self._pool={}
-    self._free=[]
-    self._use={}
+    self._pool=set()
+    self._free=collections.deque()
+    self._use=set()
+    self._waiters=collections.deque()
+    # number of connections being opened without the lock held, plus slots reserved for
+    # woken waiters. They count towards poolmax so concurrent callers can't overshoot it.
+    self._opening=0
     self._cleanupthread=_NimueCleanupThread(self)
+    self._cleanupstarted=False
+    # Shut down the cleanup thread on close(), or when the pool is garbage collected
+    # without being closed. Not at interpreter exit though, as the thread is a daemon.
+    self._finalizer=weakref.finalize(self,_closepool,self._exitevent,self._cleanupthread)
+    self._finalizer.atexit=False
 
     # parameter validations
     if poolmin < 0:
@@ -85,6 +123,8 @@ class NimueConnectionPool:
       raise error.NimueInvalidParameterValue("Value for idle_timeout cannot be less than 0")
     if not callable(healthcheck_callback):
       raise error.NimueInvalidParameterValue("Value for healthcheck_callback must be callable")
+    if healthcheck_interval < 0:
+      raise error.NimueInvalidParameterValue("Value for healthcheck_interval cannot be less than 0")
 
     # set internal values from parameters
     self._connfunc=connfunc
@@ -101,6 +141,7 @@ class NimueConnectionPool:
     self._idle_timeout=idle_timeout
     self._healthcheck_on_getconnection=healthcheck_on_getconnection
     self._healthcheck_callback=healthcheck_callback
+    self._healthcheck_interval=healthcheck_interval
 
     # stats counters
     self._connections_cleaned_dead=0
@@ -112,20 +153,32 @@ class NimueConnectionPool:
       initial=self._poolmin
     else:
       initial=self._poolinit
-    while len(self._pool) < initial:
-      self._addconnection()
+    # Open the initial connections in parallel, since each is usually a network round trip.
+    # Nothing else can see the pool yet, so no locking is needed.
+    if initial > 0:
+      with concurrent.futures.ThreadPoolExecutor(max_workers=min(initial,_CONNECT_MAX_WORKERS)) as executor:
+        futures=[executor.submit(self._newmember) for x in range(0,initial)]
+      for future in futures:
+        if future.exception() is None:
+          member=future.result()
+          self._pool.add(member)
+          self._free.append(member)
+      # if any connection attempt failed, close the ones that succeeded and raise the failure
+      for future in futures:
+        if future.exception() is not None:
+          for member in self._free:
+            try:
+              member.close()
+            except Exception:
+              pass
+          raise future.exception()
 
     # identify the dbmodule used by connections since
     # we need to know it to reference its exceptions
     self._dbmodule=self._finddbmodule()
 
-    # start the healthcheck thread
-    self._cleanupthread.start()
-
-  def __del__(self):
-    # only call close if at least these attributes have been initialized already
-    if len(set(('_lock','_exitevent','_pool','_free','_use','_cleanupthread')) & set(vars(self))) > 0:
-      self.close()
+    # the cleanup thread is started on the first getconnection call, so pools
+    # that are never used don't pay for it
 
   def __enter__(self):
     return self
@@ -155,8 +208,7 @@ class NimueConnectionPool:
   @property
   def poolinit(self):
     """Initial size of the pool used at pool initialization. Read-only."""
-    with self._lock:
-      return self._poolinit
+    return self._poolinit
 
   @property
   def poolmin(self):
@@ -165,16 +217,16 @@ class NimueConnectionPool:
 
     :raises NimueInvalidParameterValue: If attempting to set value less than 0 or greater than poolmax.
     """
-    with self._lock:
-      return self._poolmin
+    return self._poolmin
 
   @poolmin.setter
   def poolmin(self,val):
     if val < 0:
       raise error.NimueInvalidParameterValue("Value for poolmin cannot be less than 0")
-    if val > self.poolmax:
-      raise error.NimueInvalidParameterValue("Value for poolmin cannot be greater than value for poolmax")
+    # check against poolmax under the lock, so a concurrent poolmax update can't slip in between
     with self._lock:
+      if val > self._poolmax:
+        raise error.NimueInvalidParameterValue("Value for poolmin cannot be greater than value for poolmax")
       self._poolmin=val
 
   @property
@@ -185,17 +237,17 @@ class NimueConnectionPool:
 
     :raises NimueInvalidParameterValue: If attempting to set value less than 1 or less than poolmin (whichever is greater).
     """
-    with self._lock:
-      return self._poolmax
+    return self._poolmax
 
   @poolmax.setter
   def poolmax(self,val):
     if val < 1:
       raise error.NimueInvalidParameterValue("Value for poolmax cannot be less than 1")
-    if val < self.poolmin:
-      raise error.NimueInvalidParameterValue("Value for poolmax cannot be less than value for poolmin")
     with self._lock:
+      if val < self._poolmin:
+        raise error.NimueInvalidParameterValue("Value for poolmax cannot be less than value for poolmin")
       self._poolmax=val
+      self._wakewaiters()
 
   @property
   def cleanup_interval(self):
@@ -204,8 +256,7 @@ class NimueConnectionPool:
 
     :raises NimueInvalidParameterValue: If attempting to set to value that is not greater than 0.
     """
-    with self._lock:
-      return self._cleanup_interval
+    return self._cleanup_interval
 
   @cleanup_interval.setter
   def cleanup_interval(self,val):
@@ -221,8 +272,7 @@ class NimueConnectionPool:
 
     :raises NimueInvalidParameterValue: If attempting to set value less than 0.
     """
-    with self._lock:
-      return self._idle_timeout
+    return self._idle_timeout
 
   @idle_timeout.setter
   def idle_timeout(self,val):
@@ -231,87 +281,204 @@ class NimueConnectionPool:
     with self._lock:
       self._idle_timeout=val
 
-  def _addconnection(self):
-    member=_NimueConnectionPoolMember(self,conn=self._connfunc(*self._connargs,**self._connkwargs))
+  @property
+  def healthcheck_interval(self):
+    """
+    Time in seconds since a free connection was last used or healthchecked, before the cleanup thread healthchecks it
+    again. Can be updated. Cannot be less than 0.
+
+    :raises NimueInvalidParameterValue: If attempting to set value less than 0.
+    """
+    return self._healthcheck_interval
+
+  @healthcheck_interval.setter
+  def healthcheck_interval(self,val):
+    if val < 0:
+      raise error.NimueInvalidParameterValue("Value for healthcheck_interval cannot be less than 0")
     with self._lock:
-      self._pool[member]=1
-      self._free.insert(0,member)
-      self._lock.notify()
+      self._healthcheck_interval=val
+
+  def _newmember(self):
+    return _NimueConnectionPoolMember(self,conn=self._connfunc(*self._connargs,**self._connkwargs))
+
+  def _release(self,member):
+    # Hand member directly to the longest waiting thread if there is one, otherwise
+    # return it to the free list. Must be called with _lock held.
+    if self._waiters:
+      self._waiters.popleft().wake(member)
+    else:
+      self._free.append(member)
+
+  def _cancelwaiter(self,waiter):
+    # Withdraw a waiter that is giving up. If it was woken in the meantime, pass on the
+    # connection or reserved slot it was given. Must be called with _lock held.
+    if not waiter.woken():
+      self._waiters.remove(waiter)
+    elif waiter.member is not None:
+      self._release(waiter.member)
+    else:
+      self._opening-=1
+      self._wakewaiters()
+
+  def _wakewaiters(self):
+    # Wake as many waiting threads as there is room to add new connections to the pool,
+    # so they don't keep waiting for a connection to be returned. Each woken thread has
+    # a slot reserved for it in _opening, so a caller arriving before it gets the lock
+    # back can't take the slot, and calling this again doesn't wake more threads than
+    # there is room for. Must be called with _lock held.
+    for x in range(0,min(len(self._waiters),self._poolmax-len(self._pool)-self._opening)):
+      self._opening+=1
+      self._waiters.popleft().wake()
 
   def _cleanpool(self):
+    # Take the free connections due a healthcheck out of circulation while they are
+    # checked, so nothing can check one out mid-check. They still count towards the
+    # pool size. Connections used or checked more recently than healthcheck_interval
+    # are assumed healthy, and stay available for checkout throughout.
+    # read the clock once for the whole pass
+    now=time.monotonic()
+    with self._lock:
+      checking=[]
+      skipped=[]
+      for member in self._free:
+        if member.needshealthcheck(self._healthcheck_interval,now):
+          checking.append(member)
+        else:
+          skipped.append(member)
+      if checking:
+        self._free.clear()
+        self._free.extend(skipped)
+
+    # Healthcheck without holding the lock, so the network round trips don't stall
+    # other threads, and run the checks in parallel so they take about as long as
+    # the slowest one rather than the sum of all of them.
+    def check(member):
+      # A custom healthcheck_callback may raise. Count that as a failed check, so the
+      # members taken off the free list above all make it back into circulation.
+      try:
+        return member.healthcheck(now=now)
+      except Exception:
+        logger.exception("Unexpected exception during healthcheck. Connection will be invalidated.")
+        return False
+    results=[]
+    if len(checking) > 0:
+      with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(checking),_HEALTHCHECK_MAX_WORKERS)) as executor:
+        results=list(executor.map(check,checking))
+
+    # connections removed from the pool, to be closed once the lock is released
+    closing=[]
     with self._lock:
-      idle=[]
-      dead=[]
-
-      # identify and clear dead connections
-      for x in enumerate(self._free):
-        if not x[1].healthcheck():
-          dead.append(x[0])
-      for x in sorted(dead,reverse=True):
-        try:
-          self._free[x].close()
-        except:
-          pass
-        del self._pool[self._free[x]]
-        del self._free[x]
+      # clear dead connections
+      alive=[]
+      for member,healthy in zip(checking,results):
+        if healthy:
+          alive.append(member)
+          continue
+        closing.append(member)
+        self._pool.remove(member)
         self._connections_cleaned_dead+=1
 
+      # Return healthy connections to the pool, serving any threads that started waiting
+      # in the meantime first. The rest are merged back in by last use, so the free list
+      # is ordered with the most recently used connections on top. Sort even if there are
+      # none: connections are stamped before their thread takes the lock to return them,
+      # so two returned close together can land out of order. The list is nearly sorted
+      # already, which makes this cheap.
+      while alive and self._waiters:
+        self._waiters.popleft().wake(alive.pop())
+      merged=sorted(itertools.chain(self._free,alive),key=lambda member: member._touch_time)
+      self._free.clear()
+      self._free.extend(merged)
+      # if dead connections were removed, threads still waiting may be able to add new ones
+      self._wakewaiters()
+
       # figure out the maximum idle connections we can remove
       idletarget=len(self._pool)-self._poolmin
       if len(self._free) < idletarget:
         idletarget=len(self._free)
 
-      # if we can possibly remove any connections, proceed
-      if idletarget > 0:
-        # identify idle connections that are removal candidates
-        now=time.monotonic()
-        for x in enumerate(self._free):
-          if now-x[1]._touch_time > self._idle_timeout:
-            idle.append(x[0])
-
-        # remove oldest idle connections up to idletarget
-        for x in sorted(sorted(idle,key=lambda z: (now-self._free[z]._touch_time, self._free[z]._create_time), reverse=True)[0:idletarget],reverse=True):
-          try:
-            self._free[x].close()
-          except:
-            pass
-          del self._pool[self._free[x]]
-          del self._free[x]
-          self._connections_cleaned_idle+=1
+      # The free list is ordered by last use with the oldest on the left, so the oldest
+      # idle connections can simply be taken off the left end, up to idletarget.
+      while idletarget > 0 and now-self._free[0]._touch_time > self._idle_timeout:
+        member=self._free.popleft()
+        closing.append(member)
+        self._pool.remove(member)
+        self._connections_cleaned_idle+=1
+        idletarget-=1
 
       # After removing dead and idle connections, if pool size is in excess of poolmax (because poolmax may have been decreased)
       # remove oldest free connections to try to get back under poolmax. If there aren't enough free connections, we
       # may still be in excess of poolmax though.
       poolmax_excess=len(self._pool) - self._poolmax
-      if poolmax_excess > 0:
-        for x in sorted(sorted(enumerate(self._free),key=lambda z: (now-z[1]._touch_time, z[1]._create_time), reverse=True)[0:poolmax_excess],key=lambda z: z[0],reverse=True):
-          del self._pool[x[1]]
-          del self._free[x[0]]
-
-      # add connections till we get back up to _poolmin
-      addtarget=self._poolmin - len(self._pool)
-      if addtarget > 0:
-        for x in range(0,addtarget):
-          try:
-            self._addconnection()
-          except:
-            logger.exception("Failed to add connection while pool size below poolmin")
-    self._cleanup_cycles+=1
+      while poolmax_excess > 0 and self._free:
+        member=self._free.popleft()
+        closing.append(member)
+        self._pool.remove(member)
+        poolmax_excess-=1
+
+      # Work out how many connections to add to get back up to _poolmin, and reserve
+      # the slots so getconnection() can't overshoot poolmax while they're opened.
+      addtarget=max(self._poolmin-len(self._pool)-self._opening,0)
+      self._opening+=addtarget
+
+    # Closing and opening connections can block on the network, so do it without the lock.
+    for member in closing:
+      try:
+        member.close()
+      except Exception:
+        pass
+    added=[]
+    for x in range(0,addtarget):
+      try:
+        added.append(self._newmember())
+      except Exception:
+        logger.exception("Failed to add connection while pool size below poolmin")
+
+    with self._lock:
+      self._opening-=addtarget
+      for member in added:
+        self._pool.add(member)
+        self._release(member)
+      # slots reserved for connections that failed to open may be usable by waiting threads
+      if len(added) < addtarget:
+        self._wakewaiters()
+      self._cleanup_cycles+=1
 
   def _finddbmodule(self):
+    # The module connfunc was defined in usually is the driver module (psycopg2.connect,
+    # sqlite3.connect...), which saves opening a connection just to look at its class.
+    # Only trust it if it looks like a DBAPI module, since connfunc may be a user wrapper.
+    modulename=getattr(self._connfunc,'__module__',None)
+    if modulename is not None:
+      dbmodule=self._walkdbmodule(modulename)
+      if dbmodule is not None:
+        return dbmodule
     with self._lock:
-      if len(self._free) == 0:
-        with contextlib.closing(self._connfunc(*self._connargs,**self._connkwargs)) as conn:
-          modulename=conn.__class__.__module__
-      else:
-        modulename=self._free[0]._conn.__class__.__module__
-      components=modulename.split('.')
-      while len(components) > 0:
-        dbmodule=importlib.import_module('.'.join(components))
-        if 'connect' in dir(dbmodule):
-          return dbmodule
-        del components[-1]
+      member=self._free[0] if self._free else None
+    if member is None:
+      # no connection to look at, so open one without holding the lock
+      with contextlib.closing(self._connfunc(*self._connargs,**self._connkwargs)) as conn:
+        modulename=conn.__class__.__module__
+    else:
+      modulename=member._conn.__class__.__module__
+    dbmodule=self._walkdbmodule(modulename)
+    if dbmodule is None:
       raise error.NimueDBModuleFailure("Could not determine main dbmodule")
+    return dbmodule
+
+  @staticmethod
+  def _walkdbmodule(modulename):
+    # Walk up the package hierarchy from modulename to the first module that looks like a DBAPI module.
+    components=modulename.split('.')
+    while len(components) > 0:
+      try:
+        dbmodule=importlib.import_module('.'.join(components))
+      except ImportError:
+        return None
+      if _isdbmodule(dbmodule):
+        return dbmodule
+      del components[-1]
+    return None
 
   def getconnection(self,blocking=True,timeout=None):
     """
@@ -323,6 +490,7 @@ class NimueConnectionPool:
     :returns: Returns a NimueConnection object, or None if one is not available.
     If blocking is set to False, a getconnection attempts to return a free connection from the pool. If all connections are in use, and no more can be added, None is returned. Otherwise, If healthcheck_on_getconnection is set for the pool, a connection will be healthchecked before being returned to the caller. If the healthcheck fails, another connection will be tried (and the original connection discarded from the pool). If all available connections fail their healthcheck, a single new connection attempt will be made. If this attempt fails, an Exception will be raised (see below). If the connection succeeds, but the new connection subsequently fails its healthcheck, None is returned. If healthcheck_on_getconnection is set to False, behavior is similar, but connections will not be healthchecked. In this case an unhealthy connection may be returned to the caller, and it is the caller's responsibility to handle that case.
     If blocking is set to True, behavior is same as described above, but if no connections are available, the method will block until one becomes available. Also, if healthcheck_on_getconnection is True, and a new connection needs to be opened, a failed healthcheck on the new connection will retry repeatedly until a healthy connection can be obtained. An Exception may still be raised on a total failure to connect however (see below). If a timeout is also specified, the above behavior continues until the timeout is elapsed. If no connection could be obtained, None is returned, as when blocking is set to False.
+    Free connections are handed out most recently used first, since those are the least likely to have been closed by the server in the meantime. Threads blocked waiting for a connection are served in the order they started waiting.
 
     :raises NimueInvalidParameterValue: If timeout is set to an invalid value.
     :raises NimuePoolClosedError: If a connection is requested from a pool that has already been closed.
@@ -340,60 +508,145 @@ class NimueConnectionPool:
     if not r:
       raise error.NimueNoConnectionAvailable("Timeout expired acquiring lock on pool.")
 
-    # At this point we have the lock - the context manager ensures we release it
-    with contextlib.ExitStack() as stack:
-      stack.push(self._lock)
+    # At this point we have the lock - the finally clause ensures we release it
+    try:
       # if _exitevent has been set, the pool is being torn down, so raise an exception
       if self._exitevent.is_set():
         raise error.NimuePoolClosedError("Pool %s has already been closed." % self)
+      if not self._cleanupstarted:
+        self._cleanupthread.start()
+        self._cleanupstarted=True
 
       badnewconns=0
+      # set once we have waited our turn in the queue of waiting threads
+      waited=False
+      # set when we were woken with a slot reserved for us to open a new connection
+      reserved=False
       while True:
         # if there's a free connection in the pool, we are good
-        if len(self._free) > 0:
-          member=self._free.pop(0)
+        if self._free and not reserved:
+          member=self._free.pop()
           if self._healthcheck_on_getconnection:
-            # if we fail healthcheck, remove from pool and start over
-            if not member.healthcheck():
-              member.close()
-              del self._pool[member]
+            # Healthcheck without holding the lock, so the round trip doesn't stall other
+            # threads. The member is neither free nor in use meanwhile, so nothing else
+            # can pick it up.
+            self._lock.release()
+            healthy=False
+            try:
+              healthy=member.healthcheck()
+            finally:
+              # if we fail healthcheck (or it raises), remove from pool and start over
+              if not healthy:
+                try:
+                  member.close()
+                except Exception:
+                  pass
+              self._lock.acquire()
+              if not healthy:
+                self._pool.remove(member)
+                # threads may have queued up while the check ran, and there is now room for them to add a connection
+                self._wakewaiters()
+            if not healthy:
               continue
-          self._use[member]=1
-          return NimueConnection(self,member)
-        # if there's not, but there's room to add a new connection, we are also good
-        elif len(self._pool.keys()) < self._poolmax:
+          self._use.add(member)
+          break
+        # if there's not, but there's room to add a new connection, we are also good -
+        # unless other threads are already queued waiting, in which case they go first
+        elif reserved or (len(self._pool)+self._opening < self._poolmax and (waited or not self._waiters)):
           # if we've been failing healthchecks on new connections though, check if
           # we are over time or in nonblocking mode
           if badnewconns > 0:
             if (blocking and timeout-(time.monotonic()-entertime) <= 0):
+              if reserved:
+                # pass the slot reserved for us on to the next waiter
+                self._opening-=1
+                self._wakewaiters()
               raise error.NimueNoConnectionAvailable("Timeout expired trying to obtain a healthy connection.")
             if not blocking:
               raise error.NimueNoConnectionAvailable("Could not obtain a healthy connection.")
-          self._addconnection()
-          member=self._free.pop(0)
-          if self._healthcheck_on_getconnection:
-          # go ahead and healthcheck the new connection as well
-            if not member.healthcheck():
-              member.close()
-              del self._pool[member]
-              badnewconns+=1
-              continue
-          self._use[member]=1
-          return NimueConnection(self,member)
+          # Reserve a slot (unless one was reserved for us when we were woken) and open
+          # the connection without holding the lock, so a slow connect doesn't stall
+          # other threads.
+          if reserved:
+            reserved=False
+          else:
+            self._opening+=1
+          self._lock.release()
+          member=None
+          try:
+            member=self._newmember()
+            # go ahead and healthcheck the new connection as well. If the check raises,
+            # count it as failed rather than leak the connection.
+            if self._healthcheck_on_getconnection:
+              try:
+                healthy=member.healthcheck()
+              except Exception:
+                logger.exception("Unexpected exception during healthcheck. Connection will be invalidated.")
+                healthy=False
+              if not healthy:
+                dead,member=member,None
+                try:
+                  dead.close()
+                except Exception:
+                  pass
+          finally:
+            self._lock.acquire()
+            self._opening-=1
+            # if we didn't get a connection, the reserved slot may be usable by a waiting thread
+            if member is None:
+              self._wakewaiters()
+          if member is None:
+            badnewconns+=1
+            continue
+          # register the new connection directly as ours rather than going through
+          # the free list, where it could be handed off to a waiting thread
+          self._pool.add(member)
+          self._use.add(member)
+          break
         # but if neither of those are true, now we have to wait
         # (or give up if blocking is False)
         else:
           if not blocking:
             raise error.NimueNoConnectionAvailable("All connections currently in use.")
-          # if timeout is -1, block indefinitely, else block for the remaining time
-          if timeout == -1:
-            r=self._lock.wait_for(lambda: len(self._free) > 0,None)
-          else:
-            r=self._lock.wait_for(lambda: len(self._free) > 0,timeout-(time.monotonic()-entertime))
-          if not r:
+          # queue up as a waiter and release the lock - the next connection returned to
+          # the pool is handed directly to the waiter at the head of the queue, so
+          # waiting threads are served in FIFO order
+          waiter=_NimueWaiter()
+          self._waiters.append(waiter)
+          self._lock.release()
+          try:
+            # if timeout is -1, block indefinitely, else block for the remaining time
+            if timeout == -1:
+              waiter.wait(None)
+            else:
+              waiter.wait(timeout-(time.monotonic()-entertime))
+          except BaseException:
+            # interrupted (KeyboardInterrupt and the like), so don't leave the waiter
+            # queued to swallow a connection nobody will pick up
+            self._lock.acquire()
+            self._cancelwaiter(waiter)
+            raise
+          self._lock.acquire()
+          # we may have been woken after the wait timed out but before we got
+          # the lock back, so check for that before giving up
+          if not waiter.woken():
+            self._cancelwaiter(waiter)
             raise error.NimueNoConnectionAvailable("Timeout expired waiting for an available connection.")
-          # At this point, there might be a connection available, so do nothing, go
-          # back to the top of the loop, and hopefully get a connection
+          waited=True
+          # If we were handed a connection, put it where the top of the loop will pick it up,
+          # so it gets the same healthcheck treatment as any other free connection. Otherwise
+          # we were woken because there is room to add a new connection, and a slot has
+          # been reserved for us.
+          if waiter.member is not None:
+            self._free.append(waiter.member)
+          else:
+            reserved=True
+    finally:
+      self._lock.release()
+
+    # The member is already recorded as in use, so nothing else can hand it out.
+    # Build the wrapper after releasing the lock to keep the critical section short.
+    return NimueConnection(self,member)
 
   def poolstats(self):
     """
@@ -409,14 +662,26 @@ class NimueConnectionPool:
 
   def close(self):
     """
-    Close the connection pool, and shutdown the associated cleanup thread. Note that this method will block
-    until all outstanding connections have been returned to the pool.
+    Close the connection pool, its free connections, and shutdown the associated cleanup thread. Connections still
+    in use are closed when they are returned.
     """
     # shutdown the cleanup thread
-    self._exitevent.set()
-    self._cleanupthread.join()
+    self._finalizer()
+    # Close the free connections. Connections still in use are closed as they are
+    # returned, since the pool is now marked closed.
+    with self._lock:
+      closing=list(self._free)
+      self._free.clear()
+      self._pool.difference_update(closing)
+    for member in closing:
+      try:
+        member.close()
+      except Exception:
+        pass
 
 class _NimueConnectionPoolMember:
+  __slots__=('_owner','_conn','_create_time','_touch_time','_check_time','_healthcheck_callback')
+
   def __init__(self,owner,conn):
     self._owner=owner
     self._conn=conn
@@ -425,11 +690,18 @@ class _NimueConnectionPoolMember:
     self._check_time=self._create_time
     self._healthcheck_callback=self._owner.healthcheck_callback
 
-  def healthcheck(self):
-    with self._owner._lock:
-      dbmodule=self._owner._dbmodule
-    r=self._healthcheck_callback(self._conn,dbmodule)
-    self._check_time=time.monotonic()
+  def needshealthcheck(self,max_age,now):
+    # A connection used or checked more recently than max_age is assumed to be healthy.
+    return now-max(self._touch_time,self._check_time) >= max_age
+
+  def healthcheck(self,now=None):
+    # now lets a caller checking many members read the clock only once
+    if now is None:
+      now=time.monotonic()
+    # _dbmodule is set once during pool initialization, before any healthcheck
+    # can run, so it can be read without the lock
+    r=self._healthcheck_callback(self._conn,self._owner._dbmodule)
+    self._check_time=now
     return r
 
   def touch(self):
@@ -438,6 +710,23 @@ class _NimueConnectionPoolMember:
   def close(self):
     self._conn.close()
 
+class _NimueWaiter:
+  __slots__=('member','_event')
+
+  def __init__(self):
+    self.member=None
+    self._event=threading.Event()
+
+  def wait(self,timeout):
+    return self._event.wait(timeout)
+
+  def woken(self):
+    return self._event.is_set()
+
+  def wake(self,member=None):
+    self.member=member
+    self._event.set()
+
 class NimueConnection:
   """
   Wrapper around a DBAPI 2.0 compliant Connection object. Should not be initialized directly, but is
@@ -449,6 +738,9 @@ class NimueConnection:
   return them to the pool. The object destructor issues a warning if a connection object is destroyed
   without first being closed.
   """
+  # __weakref__ keeps wrappers weak-referenceable, as they were before __slots__
+  __slots__=('_member','_pool','_closed','_conn','__weakref__')
+
   def __init__(self,pool,member):
     self._member=member
     self._pool=pool
@@ -456,15 +748,17 @@ class NimueConnection:
     self._conn=member._conn
 
   def __getattr__(self,attr):
-    if attr in self.__dict__:
-      return getattr(self, attr)
+    # only called when normal lookup fails, so forward to the underlying connection -
+    # unless it's one of our own slots, which are only missing after close()
+    if attr in NimueConnection.__slots__:
+      raise AttributeError(attr)
     return getattr(self._conn,attr)
 
   def __setattr__(self,attr,value):
-    if attr in ('_pool','_conn','_member','_closed'):
-      self.__dict__[attr]=value
+    if attr in NimueConnection.__slots__:
+      object.__setattr__(self,attr,value)
     else:
-      self._conn.__setattr__(attr,value)
+      setattr(self._conn,attr,value)
 
   def __del__(self):
     if not self._closed:
@@ -478,6 +772,20 @@ class NimueConnection:
   def __exit__(self,exc_type,exc_value,traceback):
     self._conn.__exit__(exc_type,exc_value,traceback)
 
+  # The DBAPI methods used on nearly every checkout are defined directly,
+  # so calling them doesn't go through __getattr__.
+  def cursor(self,*args,**kwargs):
+    """Return a new Cursor object from the underlying connection."""
+    return self._conn.cursor(*args,**kwargs)
+
+  def commit(self):
+    """Commit any pending transaction on the underlying connection."""
+    return self._conn.commit()
+
+  def rollback(self):
+    """Roll back any pending transaction on the underlying connection."""
+    return self._conn.rollback()
+
   def close(self):
     """Return this connection to the pool. Do not attempt to call methods on the object after close()."""
     # if _closed is True, we do nothing and return
@@ -492,11 +800,12 @@ class NimueConnection:
       return
 
     self._conn.rollback()
+    # nothing else looks at the member's timestamps while it's in use,
+    # so read the clock before taking the lock
+    self._member.touch()
     with self._pool._lock:
-      del self._pool._use[self._member]
-      self._pool._free.insert(0,self._member)
-      self._member.touch()
-      self._pool._lock.notify()
+      self._pool._use.remove(self._member)
+      self._pool._release(self._member)
     # explicitly remove references to other objects
     del self._member
     del self._pool
@@ -517,6 +826,8 @@ class NimueConnectionPoolStats:
   cleanup cycles during the pool's lifetime.
   :attribute cleanup_cycles: Number of cleanup cycles that have run during the pool's lifetime.
   """
+  __slots__=('poolsize','poolused','poolfree','connections_cleaned_dead','connections_cleaned_idle','cleanup_cycles')
+
   def __init__(self,poolsize,poolused,poolfree,connections_cleaned_dead,connections_cleaned_idle,cleanup_cycles):
     self.poolsize=poolsize
     self.poolused=poolused
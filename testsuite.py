@@ -3,14 +3,15 @@
 # Copyright (c) 2021-2022 James Lucas
 
 import contextlib
+import gc
 import logging
-import os.path
-import shutil
-import tempfile
+import sys
 import threading
 import time
+import types
 import unittest
 import unittest.mock
+import weakref
 
 import nimue
 import nimue.callback
@@ -19,19 +20,20 @@ dbdriver='sqlite3'
 
 if dbdriver=='sqlite3':
   import sqlite3
-  tempdir=tempfile.mkdtemp()
   connfunc=sqlite3.connect
-  connargs=(os.path.join(tempdir,'testdb'),)
-  connkwargs={'check_same_thread': False}
+  # a shared-cache in-memory database, so pool members all see the same database
+  # without any disk I/O
+  connargs=('file:nimue_test?mode=memory&cache=shared',)
+  connkwargs={'check_same_thread': False, 'uri': True}
   poolkwargs=dict()
   hasdual=False
   notaballowed=True
 
   def driver_cleanup():
-    os.unlink(os.path.join(tempdir,'testdb'))
+    pass
 
   def final_cleanup():
-    shutil.rmtree(tempdir)
+    pass
 
   def autocommit_off(conn):
     conn.isolation_level=None
@@ -123,26 +125,61 @@ elif dbdriver=='cx_Oracle':
 else:
   raise Exception("Invalid dbdriver")
 
-class FakeThread(nimue.nimue._NimueCleanupThread):
-  def __init__(self,owner):
-    pass
-
-  def run(self):
-    pass
-
-  def start(self):
-    pass
-
-class PoolTests(unittest.TestCase):
+class NimueTestCase(unittest.TestCase):
   def setUp(self):
-    def createpool(**kwargs):
-      createpoolkwargs=poolkwargs.copy()
-      createpoolkwargs.update(kwargs)
-      return nimue.NimueConnectionPool(connfunc,connargs,connkwargs,**createpoolkwargs)
-    self.createpool=createpool
-
-  @unittest.mock.patch('nimue.nimue._NimueCleanupThread')
-  def testGetters(self,FakeThread):
+    # pools under test don't run the background cleanup thread; tests drive _cleanpool() directly
+    self._realcleanupthread=nimue.nimue._NimueCleanupThread
+    patcher=unittest.mock.patch('nimue.nimue._NimueCleanupThread')
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def createpool(self,**kwargs):
+    # kwargs override the driver defaults in poolkwargs
+    return nimue.NimueConnectionPool(connfunc,connargs,connkwargs,**dict(poolkwargs,**kwargs))
+
+  def assertPoolStats(self,pool,size=None,used=None,free=None):
+    """Assert on several pool size stats, taken from a single poolstats() snapshot."""
+    stats=pool.poolstats()
+    if size is not None:
+      self.assertEqual(stats.poolsize,size)
+    if used is not None:
+      self.assertEqual(stats.poolused,used)
+    if free is not None:
+      self.assertEqual(stats.poolfree,free)
+
+  def getconnections(self,pool,stack,count):
+    """Check out count connections from pool, to be closed when stack exits."""
+    conns=[]
+    # registered first, so connections already obtained are closed if a later getconnection fails
+    stack.callback(self._closeconnections,conns)
+    for x in range(0,count):
+      conns.append(pool.getconnection())
+    return conns
+
+  @staticmethod
+  def _closeconnections(conns):
+    for conn in conns:
+      conn.close()
+
+  def waitforwaiters(self,pool,count=1,timeout=5):
+    """Wait until count threads are queued waiting on pool, failing the test after timeout seconds."""
+    deadline=time.monotonic()+timeout
+    while True:
+      with pool._lock:
+        if len(pool._waiters) >= count:
+          return
+      if time.monotonic() >= deadline:
+        self.fail("Timed out waiting for %d threads to queue on the pool" % count)
+      time.sleep(.01)
+
+  @staticmethod
+  def _checkoutthread(pool,result):
+    # thread target checking out a connection and recording which member it got
+    with contextlib.closing(pool.getconnection(timeout=10)) as conn:
+      result.append(conn._member)
+
+class PoolTests(NimueTestCase):
+  def testGetters(self):
     """Test NimueConnectionPool property getters."""
     with self.createpool(poolmin=2,poolmax=4) as pool:
       self.assertEqual(pool.connfunc,connfunc)
@@ -152,9 +189,9 @@ class PoolTests(unittest.TestCase):
       self.assertEqual(pool.poolmax,4)
       self.assertEqual(pool.cleanup_interval,60)
       self.assertEqual(pool.idle_timeout,300)
+      self.assertEqual(pool.healthcheck_interval,30)
 
-  @unittest.mock.patch('nimue.nimue._NimueCleanupThread')
-  def testSetterValidation(self,FakeThread):
+  def testSetterValidation(self):
     """Test validation of NimueConnectionPool property setters."""
     with self.createpool(poolmin=0,poolmax=5) as pool:
       with self.assertRaises(Exception):
@@ -163,56 +200,262 @@ class PoolTests(unittest.TestCase):
         pool.poolmin=6
       with self.assertRaises(Exception):
         pool.poolmax=0
+      with self.assertRaises(Exception):
+        pool.healthcheck_interval=-1
 
     with self.createpool(poolmin=4,poolmax=5) as pool:
       with self.assertRaises(Exception):
         pool.poolmax=3
 
-  @unittest.mock.patch('nimue.nimue._NimueCleanupThread')
-  def testInitialSizeMin(self,FakeThread):
+  def testInitialSizeMin(self):
     """Test poolmin during pool initialization."""
     with self.createpool(poolmin=2,poolmax=4) as pool:
       self.assertEqual(pool.poolstats().poolsize,2)
 
-  @unittest.mock.patch('nimue.nimue._NimueCleanupThread')
-  def testInitialSizeInit(self,FakeThread):
+  def testInitialSizeInit(self):
     """Test poolinit during pool initialization."""
     with self.createpool(poolmin=2,poolmax=4,poolinit=3) as pool:
       self.assertEqual(pool.poolstats().poolsize,3)
 
-  @unittest.mock.patch('nimue.nimue._NimueCleanupThread')
-  def testMaxSize(self,FakeThread):
+  def testFindDBModule(self):
+    """Test the dbmodule is found from connfunc without opening a connection, falling back to probing one."""
+    # connfunc itself may come from a private extension module (sqlite3.connect is from _sqlite3),
+    # so take the driver module from a connection's class instead
+    with contextlib.closing(connfunc(*connargs,**connkwargs)) as conn:
+      drivermodule=conn.__class__.__module__
+    mockconnfunc=unittest.mock.Mock(wraps=connfunc)
+    mockconnfunc.__module__=drivermodule
+    with nimue.NimueConnectionPool(mockconnfunc,connargs,connkwargs,poolmin=0,**poolkwargs) as pool:
+      self.assertEqual(mockconnfunc.call_count,0)
+      self.assertTrue(hasattr(pool._dbmodule,'OperationalError'))
+    # a wrapper defined outside the driver makes the pool look at a real connection
+    mockconnfunc=unittest.mock.Mock(wraps=connfunc)
+    mockconnfunc.__module__=__name__
+    with nimue.NimueConnectionPool(mockconnfunc,connargs,connkwargs,poolmin=0,**poolkwargs) as pool:
+      self.assertEqual(mockconnfunc.call_count,1)
+      self.assertTrue(hasattr(pool._dbmodule,'OperationalError'))
+    # so does a module with only some of the DBAPI module attributes
+    notdbapi=types.ModuleType('nimue_notdbapi')
+    notdbapi.connect=connfunc
+    notdbapi.Error=Exception
+    notdbapi.OperationalError=Exception
+    mockconnfunc=unittest.mock.Mock(wraps=connfunc)
+    mockconnfunc.__module__=notdbapi.__name__
+    with unittest.mock.patch.dict(sys.modules,{notdbapi.__name__: notdbapi}):
+      with nimue.NimueConnectionPool(mockconnfunc,connargs,connkwargs,poolmin=0,**poolkwargs) as pool:
+        self.assertEqual(mockconnfunc.call_count,1)
+        self.assertIsNot(pool._dbmodule,notdbapi)
+        self.assertTrue(hasattr(pool._dbmodule,'apilevel'))
+
+  def testInitialConnectFailure(self):
+    """Test connections already opened are closed if opening an initial connection fails."""
+    conns=[]
+    lock=threading.Lock()
+    def failingconnfunc():
+      with lock:
+        if len(conns) >= 2:
+          raise Exception("Connection failed")
+        conns.append(unittest.mock.Mock())
+        return conns[-1]
+    with self.assertRaises(Exception):
+      nimue.NimueConnectionPool(failingconnfunc,poolmin=4,poolmax=4)
+    self.assertEqual(len(conns),2)
+    for conn in conns:
+      self.assertTrue(conn.close.called)
+
+  def testCloseFreeConnections(self):
+    """Test closing the pool closes free connections, and connections in use once returned."""
+    with unittest.mock.patch.object(nimue.nimue._NimueConnectionPoolMember, 'close', autospec=True) as mock_method:
+      with self.createpool(poolmin=3,poolmax=3) as pool:
+        conn=pool.getconnection()
+      self.assertEqual(mock_method.call_count,2)
+      self.assertEqual(pool.poolstats().poolfree,0)
+    rawconn=conn._conn
+    conn.close()
+    with self.assertRaises(Exception):
+      rawconn.cursor()
+
+  def testCollectedPoolStopsCleanup(self):
+    """Test the cleanup thread is shut down when an unclosed pool is garbage collected."""
+    # this test needs a real cleanup thread
+    with unittest.mock.patch('nimue.nimue._NimueCleanupThread',self._realcleanupthread):
+      pool=self.createpool(poolmin=1,poolmax=1)
+    exitevent=pool._exitevent
+    cleanupthread=pool._cleanupthread
+    # the cleanup thread isn't started until the pool is first used
+    self.assertFalse(cleanupthread.is_alive())
+    pool.getconnection().close()
+    self.assertTrue(cleanupthread.is_alive())
+    poolref=weakref.ref(pool)
+    del pool
+    # the cleanup thread briefly holds a strong reference while reading its settings
+    deadline=time.monotonic()+5
+    while poolref() is not None and time.monotonic() < deadline:
+      gc.collect()
+      time.sleep(0.01)
+    self.assertTrue(exitevent.is_set())
+    self.assertFalse(cleanupthread.is_alive())
+
+  def testGetConnectionUnlocked(self):
+    """Test getconnection opens and healthchecks connections without holding the pool lock."""
+    lockheld=[]
+    pools=[]
+    def unlockedconnfunc():
+      # initial connections are opened before the pool exists
+      if pools:
+        lockheld.append(pools[0]._lock._is_owned())
+      return connfunc(*connargs,**connkwargs)
+    def unlockedhealthcheck(conn,dbmodule):
+      lockheld.append(pools[0]._lock._is_owned())
+      return True
+    with nimue.NimueConnectionPool(unlockedconnfunc,poolmin=1,poolmax=2,healthcheck_callback=unlockedhealthcheck) as pool:
+      pools.append(pool)
+      with contextlib.closing(pool.getconnection()):
+        with contextlib.closing(pool.getconnection()):
+          self.assertEqual(pool.poolstats().poolsize,2)
+    # a healthcheck of the initial connection, then a connect and a healthcheck for the second
+    self.assertEqual(lockheld,[False,False,False])
+
+  def testMaxSize(self):
     """Test poolmax during pool initialization."""
-    x=[]
     with self.createpool(poolmin=2,poolmax=4) as pool:
       with contextlib.ExitStack() as stack:
-        for y in range(0,4):
-          x.append(pool.getconnection())
-          stack.push(contextlib.closing(x[-1]))
+        self.getconnections(pool,stack,4)
         self.assertEqual(pool.poolstats().poolsize,4)
 
-  @unittest.mock.patch('nimue.nimue._NimueCleanupThread')
-  def testIdleCleanup(self,FakeThread):
+  def testIdleCleanup(self):
     """Test cleanup of idle connections."""
-    x=[]
     with self.createpool(poolmin=2,poolmax=4,idle_timeout=0) as pool:
       with contextlib.ExitStack() as stack:
-        for y in range(0,4):
-          x.append(pool.getconnection())
-          stack.push(contextlib.closing(x[-1]))
+        self.getconnections(pool,stack,4)
         self.assertEqual(pool.poolstats().poolsize,4)
       pool._cleanpool()
       self.assertEqual(pool.poolstats().poolsize,2)
 
-  @unittest.mock.patch('nimue.nimue._NimueCleanupThread')
-  def testOverMax(self,FakeThread):
+  def testIdleCleanupOutOfOrder(self):
+    """Test idle cleanup finds the oldest connections when the free list is out of last-use order."""
+    with self.createpool(poolmin=0,poolmax=2,poolinit=2,idle_timeout=300) as pool:
+      with pool._lock:
+        old,new=pool._free
+        old._touch_time-=600
+        # as if old was stamped first but its thread took the lock second
+        pool._free.rotate()
+      pool._cleanpool()
+      self.assertEqual(list(pool._free),[new])
+      self.assertEqual(pool.poolstats().connections_cleaned_idle,1)
+
+  def testOverMaxCleanup(self):
+    """Test cleanup closes free connections in excess of a lowered poolmax, oldest first."""
+    with self.createpool(poolmin=0,poolmax=4,poolinit=4,idle_timeout=300) as pool:
+      with pool._lock:
+        members=list(pool._free)
+        # make the free list order match the order the connections were last used
+        for i,member in enumerate(members):
+          member._touch_time=time.monotonic()-10+i
+      pool.poolmax=2
+      with unittest.mock.patch.object(nimue.nimue._NimueConnectionPoolMember, 'close', autospec=True) as mock_method:
+        pool._cleanpool()
+      self.assertEqual(pool.poolstats().poolsize,2)
+      self.assertEqual(mock_method.call_count,2)
+      # the most recently returned connections are kept, still in order
+      self.assertEqual(list(pool._free),members[2:])
+
+  def testCleanupUnlocked(self):
+    """Test cleanup closes and opens connections without holding the pool lock."""
+    with self.createpool(poolmin=2,poolmax=4,poolinit=4,idle_timeout=0) as pool:
+      lockheld=[]
+      def close(member):
+        lockheld.append(pool._lock._is_owned())
+      def newmember():
+        lockheld.append(pool._lock._is_owned())
+        return nimue.nimue._NimueConnectionPoolMember(pool,conn=connfunc(*connargs,**connkwargs))
+      with unittest.mock.patch.object(nimue.nimue._NimueConnectionPoolMember, 'close', autospec=True, side_effect=close):
+        pool._cleanpool()
+      self.assertEqual(pool.poolstats().poolsize,2)
+      pool.poolmin=3
+      with unittest.mock.patch.object(pool, '_newmember', side_effect=newmember):
+        pool._cleanpool()
+      self.assertEqual(pool.poolstats().poolsize,3)
+      # two idle connections closed, then one opened to get back up to poolmin
+      self.assertEqual(lockheld,[False,False,False])
+
+  def testDeadCleanup(self):
+    """Test cleanup of connections failing healthcheck."""
+    with self.createpool(poolmin=2,poolmax=4,poolinit=4,healthcheck_interval=0) as pool:
+      with contextlib.closing(pool.getconnection()):
+        with unittest.mock.patch.object(nimue.nimue._NimueConnectionPoolMember, 'healthcheck', return_value=False) as mock_method:
+          pool._cleanpool()
+        # the three free connections were checked and removed, the one in use was left alone
+        self.assertEqual(mock_method.call_count,3)
+        self.assertEqual(pool.poolstats().connections_cleaned_dead,3)
+        # and the pool was topped back up to poolmin
+        self.assertPoolStats(pool,size=2,used=1,free=1)
+
+  def testCleanupHealthcheckRaises(self):
+    """Test cleanup treats a healthcheck callback raising an exception as a failed check."""
+    calls=[]
+    def healthcheck(conn,dbmodule):
+      calls.append(conn)
+      if len(calls) == 1:
+        raise ValueError("healthcheck failure")
+      return True
+    with self.createpool(poolmin=3,poolmax=3,healthcheck_interval=0,healthcheck_callback=healthcheck) as pool:
+      with contextlib.ExitStack() as stack:
+        logging.disable(level=logging.CRITICAL)
+        stack.callback(logging.disable,level=logging.NOTSET)
+        pool._cleanpool()
+      # the member whose check raised was replaced, and the rest went back on the free list
+      self.assertEqual(pool.poolstats().connections_cleaned_dead,1)
+      self.assertPoolStats(pool,size=3,used=0,free=3)
+      with contextlib.closing(pool.getconnection(blocking=False)) as conn:
+        self.assertTrue(isinstance(conn,nimue.NimueConnection))
+
+  def testCleanupSkipsRecent(self):
+    """Test cleanup skips healthchecks of recently used connections."""
+    healthcheck=unittest.mock.Mock(return_value=True)
+    with self.createpool(poolmin=2,poolmax=4,healthcheck_callback=healthcheck) as pool:
+      pool._cleanpool()
+      self.assertEqual(healthcheck.call_count,0)
+      pool.healthcheck_interval=0
+      pool._cleanpool()
+      self.assertEqual(healthcheck.call_count,2)
+      self.assertEqual(pool.poolstats().poolfree,2)
+
+  def testCleanupSkippedStayFree(self):
+    """Test connections not due a healthcheck can still be checked out while cleanup checks the others."""
+    checking=threading.Event()
+    finishcheck=threading.Event()
+    stale=[]
+    def healthcheck(conn,dbmodule):
+      if conn in stale:
+        checking.set()
+        finishcheck.wait(5)
+      return True
+    with self.createpool(poolmin=2,poolmax=2,healthcheck_callback=healthcheck) as pool:
+      member=pool._free[0]
+      member._touch_time-=60
+      member._check_time-=60
+      stale.append(member._conn)
+      t=threading.Thread(target=pool._cleanpool)
+      t.start()
+      self.addCleanup(t.join)
+      self.addCleanup(finishcheck.set)
+      self.assertTrue(checking.wait(5))
+      # only the stale connection is out for its healthcheck
+      self.assertEqual(pool.poolstats().poolfree,1)
+      with contextlib.closing(pool.getconnection(blocking=False)) as conn:
+        self.assertNotEqual(conn._member,member)
+      finishcheck.set()
+      t.join()
+      self.assertPoolStats(pool,size=2,free=2)
+      # the checked connection went back underneath the one used since
+      self.assertEqual(pool._free[0],member)
+
+  def testOverMaxFreeSufficient(self):
     """Test cleanup of connections beyond poolmax."""
-    x=[]
     with self.createpool(poolmin=2,poolmax=10) as pool:
       with contextlib.ExitStack() as stack:
-        for y in range(0,10):
-          x.append(pool.getconnection())
-          stack.push(contextlib.closing(x[-1]))
+        self.getconnections(pool,stack,10)
         self.assertEqual(pool.poolstats().poolsize,10)
       pool.poolmax=4
       self.assertEqual(pool.poolmax,4)
@@ -221,19 +464,13 @@ class PoolTests(unittest.TestCase):
       self.assertEqual(pool.poolstats().poolsize,4)
       pool.idle_timeout=0
       pool._cleanpool()
-      self.assertEqual(pool.poolstats().poolsize,2)
-      self.assertEqual(pool.poolstats().poolfree,2)
-      self.assertEqual(pool.poolstats().poolused,0)
+      self.assertPoolStats(pool,size=2,used=0,free=2)
 
-  @unittest.mock.patch('nimue.nimue._NimueCleanupThread')
-  def testOverMax(self,FakeThread):
+  def testOverMaxFreeInsufficient(self):
     """Test cleanup of connections beyond poolmax when there are insufficient free connections."""
-    x=[]
     with self.createpool(poolmin=2,poolmax=10) as pool:
       with contextlib.ExitStack() as stack:
-        for y in range(0,10):
-          x.append(pool.getconnection())
-          stack.push(contextlib.closing(x[-1]))
+        self.getconnections(pool,stack,10)
         self.assertEqual(pool.poolstats().poolsize,10)
         pool.poolmax=4
         self.assertEqual(pool.poolmax,4)
@@ -242,130 +479,96 @@ class PoolTests(unittest.TestCase):
         self.assertEqual(pool.poolstats().poolsize,10)
         pool.idle_timeout=0
         pool._cleanpool()
-        self.assertEqual(pool.poolstats().poolsize,10)
-        self.assertEqual(pool.poolstats().poolfree,0)
-        self.assertEqual(pool.poolstats().poolused,10)
+        self.assertPoolStats(pool,size=10,used=10,free=0)
 
-  @unittest.mock.patch('nimue.nimue._NimueCleanupThread')
-  def testDefaults(self,FakeThread):
+  def testDefaults(self):
     """Test NimueConnectionPool defaults."""
-    x=[]
     with self.createpool() as pool:
       self.assertEqual(pool.poolinit,None)
       self.assertEqual(pool.poolmin,10)
       self.assertEqual(pool.poolmax,20)
       self.assertEqual(pool.cleanup_interval,60)
       self.assertEqual(pool.idle_timeout,300)
+      self.assertEqual(pool.healthcheck_interval,30)
 
-  @unittest.mock.patch('nimue.nimue._NimueCleanupThread')
-  def testParamValidation(self,FakeThread):
+  def testParamValidation(self):
     """Test validation of parameters at NimueConnectionPool construction."""
-    x=[]
-    # poolmin cannot be less than 0
-    with self.assertRaises(Exception):
-      self.createpool(poolmin=-1,poolmax=10)
-    # poolmin cannot be greater than poolmax
-    with self.assertRaises(Exception):
-      self.createpool(poolmin=11,poolmax=10)
-    # poolmax cannot be less than 1
-    with self.assertRaises(Exception):
-      self.createpool(poolmin=0,poolmax=0)
-    # poolmax cannot be less than poolmin
-    with self.assertRaises(Exception):
-      self.createpool(poolmin=5,poolmax=4)
-    # poolinit cannot be less than poolmin
-    with self.assertRaises(Exception):
-      self.createpool(poolinit=4,poolmin=5,poolmax=10)
-    # poolinit cannot be greater than poolmax
-    with self.assertRaises(Exception):
-      self.createpool(poolinit=11,poolmin=5,poolmax=10)
+    cases=(
+      ('poolmin cannot be less than 0',{'poolmin': -1,'poolmax': 10}),
+      ('poolmin cannot be greater than poolmax',{'poolmin': 11,'poolmax': 10}),
+      ('poolmax cannot be less than 1',{'poolmin': 0,'poolmax': 0}),
+      ('poolmax cannot be less than poolmin',{'poolmin': 5,'poolmax': 4}),
+      ('poolinit cannot be less than poolmin',{'poolinit': 4,'poolmin': 5,'poolmax': 10}),
+      ('poolinit cannot be greater than poolmax',{'poolinit': 11,'poolmin': 5,'poolmax': 10}),
+      ('healthcheck_interval cannot be less than 0',{'poolmin': 5,'poolmax': 10,'healthcheck_interval': -1}),
+    )
+    for msg,kwargs in cases:
+      with self.subTest(msg=msg):
+        with self.assertRaises(Exception):
+          self.createpool(**kwargs)
     with self.createpool(poolmin=2,poolmax=10) as pool:
-      with contextlib.ExitStack() as stack:
-        for y in range(0,10):
-          x.append(pool.getconnection())
-          stack.push(contextlib.closing(x[-1]))
-
-        def assertfunc():
-          pool.poolmin=12
-        self.assertRaises(Exception,assertfunc)
-
-        def assertfunc():
-          pool.poolmax=20
-          pool.poolmin=12
-        assertfunc()
-        self.assertEqual(pool.poolmax,20)
-        self.assertEqual(pool.poolmin,12)
+      # the setters only validate against the other bounds, so no connections need to be checked out
+      def assertfunc():
+        pool.poolmin=12
+      self.assertRaises(Exception,assertfunc)
+
+      def assertfunc():
+        pool.poolmax=20
+        pool.poolmin=12
+      assertfunc()
+      self.assertEqual(pool.poolmax,20)
+      self.assertEqual(pool.poolmin,12)
 
-        def assertfunc():
-          pool.poolmax=2
-        self.assertRaises(Exception,assertfunc)
+      def assertfunc():
+        pool.poolmax=2
+      self.assertRaises(Exception,assertfunc)
 
-        self.assertEqual(pool.poolmax,20)
-        self.assertEqual(pool.poolmin,12)
+      self.assertEqual(pool.poolmax,20)
+      self.assertEqual(pool.poolmin,12)
 
-        def assertfunc():
-          pool.cleanup_interval=0
-        self.assertRaises(Exception,assertfunc)
+      def assertfunc():
+        pool.cleanup_interval=0
+      self.assertRaises(Exception,assertfunc)
 
-        def assertfunc():
-          pool.idle_timeout=-1
-        self.assertRaises(Exception,assertfunc)
+      def assertfunc():
+        pool.idle_timeout=-1
+      self.assertRaises(Exception,assertfunc)
 
-  @unittest.mock.patch('nimue.nimue._NimueCleanupThread')
-  def testGetConnection(self,FakeThread):
+  def testGetConnection(self):
     """Test that getconnection returns a NimueConnection."""
     with self.createpool(poolmin=1,poolmax=5,poolinit=1) as pool:
       with contextlib.closing(pool.getconnection()) as conn:
         self.assertTrue(isinstance(conn,nimue.NimueConnection))
 
-  @unittest.mock.patch('nimue.nimue._NimueCleanupThread')
-  def testGetAtFreeZeroBlocking(self,FakeThread):
+  def testGetAtFreeZeroBlocking(self):
     """Test getconnection when no free connections in blocking mode"""
     with self.createpool(poolmin=1,poolmax=5,poolinit=1) as pool:
-      self.assertEqual(pool.poolstats().poolsize,1)
-      self.assertEqual(pool.poolstats().poolused,0)
-      self.assertEqual(pool.poolstats().poolfree,1)
+      self.assertPoolStats(pool,size=1,used=0,free=1)
       with contextlib.closing(pool.getconnection(blocking=True)) as conn:
         self.assertTrue(isinstance(conn,nimue.NimueConnection))
-        self.assertEqual(pool.poolstats().poolsize,1)
-        self.assertEqual(pool.poolstats().poolused,1)
-        self.assertEqual(pool.poolstats().poolfree,0)
+        self.assertPoolStats(pool,size=1,used=1,free=0)
         with contextlib.closing(pool.getconnection(blocking=True)) as conn2:
           self.assertTrue(isinstance(conn2,nimue.NimueConnection))
-          self.assertEqual(pool.poolstats().poolsize,2)
-          self.assertEqual(pool.poolstats().poolused,2)
-          self.assertEqual(pool.poolstats().poolfree,0)
+          self.assertPoolStats(pool,size=2,used=2,free=0)
 
-  @unittest.mock.patch('nimue.nimue._NimueCleanupThread')
-  def testGetAtFreeZeroNonBlocking(self,FakeThread):
+  def testGetAtFreeZeroNonBlocking(self):
     """Test getconnection when no free connections in non-blocking mode"""
     with self.createpool(poolmin=1,poolmax=5,poolinit=1) as pool:
-      self.assertEqual(pool.poolstats().poolsize,1)
-      self.assertEqual(pool.poolstats().poolused,0)
-      self.assertEqual(pool.poolstats().poolfree,1)
+      self.assertPoolStats(pool,size=1,used=0,free=1)
       with contextlib.closing(pool.getconnection(blocking=False)) as conn:
         self.assertTrue(isinstance(conn,nimue.NimueConnection))
-        self.assertEqual(pool.poolstats().poolsize,1)
-        self.assertEqual(pool.poolstats().poolused,1)
-        self.assertEqual(pool.poolstats().poolfree,0)
+        self.assertPoolStats(pool,size=1,used=1,free=0)
         with contextlib.closing(pool.getconnection(blocking=False)) as conn2:
           self.assertTrue(isinstance(conn2,nimue.NimueConnection))
-          self.assertEqual(pool.poolstats().poolsize,2)
-          self.assertEqual(pool.poolstats().poolused,2)
-          self.assertEqual(pool.poolstats().poolfree,0)
+          self.assertPoolStats(pool,size=2,used=2,free=0)
 
-  @unittest.mock.patch('nimue.nimue._NimueCleanupThread')
-  def testGetAtFreeZeroBlockingBadHealthcheck(self,FakeThread):
+  def testGetAtFreeZeroBlockingBadHealthcheck(self):
     """Test getconnection when no free connections in blocking mode, with failing healthcheck"""
     with self.createpool(poolmin=1,poolmax=5,poolinit=1) as pool:
-      self.assertEqual(pool.poolstats().poolsize,1)
-      self.assertEqual(pool.poolstats().poolused,0)
-      self.assertEqual(pool.poolstats().poolfree,1)
+      self.assertPoolStats(pool,size=1,used=0,free=1)
       with contextlib.closing(pool.getconnection(blocking=True)) as conn:
         self.assertTrue(isinstance(conn,nimue.NimueConnection))
-        self.assertEqual(pool.poolstats().poolsize,1)
-        self.assertEqual(pool.poolstats().poolused,1)
-        self.assertEqual(pool.poolstats().poolfree,0)
+        self.assertPoolStats(pool,size=1,used=1,free=0)
         with unittest.mock.patch.object(nimue.nimue._NimueConnectionPoolMember, 'healthcheck', return_value=False) as mock_method:
           with contextlib.ExitStack() as stack:
             conn2=None
@@ -374,22 +577,15 @@ class PoolTests(unittest.TestCase):
             if conn2 is not None:
               stack.push(contextlib.closing(conn2))
             self.assertTrue(conn2 is None)
-            self.assertEqual(pool.poolstats().poolsize,1)
-            self.assertEqual(pool.poolstats().poolused,1)
-            self.assertEqual(pool.poolstats().poolfree,0)
+            self.assertPoolStats(pool,size=1,used=1,free=0)
 
-  @unittest.mock.patch('nimue.nimue._NimueCleanupThread')
-  def testGetAtFreeZeroNonBlockingBadHealthcheck(self,FakeThread):
+  def testGetAtFreeZeroNonBlockingBadHealthcheck(self):
     """Test getconnection when no free connections in non-blocking mode, with failing healthcheck"""
     with self.createpool(poolmin=1,poolmax=5,poolinit=1) as pool:
-      self.assertEqual(pool.poolstats().poolsize,1)
-      self.assertEqual(pool.poolstats().poolused,0)
-      self.assertEqual(pool.poolstats().poolfree,1)
+      self.assertPoolStats(pool,size=1,used=0,free=1)
       with contextlib.closing(pool.getconnection(blocking=False)) as conn:
         self.assertTrue(isinstance(conn,nimue.NimueConnection))
-        self.assertEqual(pool.poolstats().poolsize,1)
-        self.assertEqual(pool.poolstats().poolused,1)
-        self.assertEqual(pool.poolstats().poolfree,0)
+        self.assertPoolStats(pool,size=1,used=1,free=0)
         with unittest.mock.patch.object(nimue.nimue._NimueConnectionPoolMember, 'healthcheck', return_value=False) as mock_method:
           with contextlib.ExitStack() as stack:
             conn2=None
@@ -398,162 +594,278 @@ class PoolTests(unittest.TestCase):
             if conn2 is not None:
               stack.push(contextlib.closing(conn2))
             self.assertTrue(conn2 is None)
-            self.assertEqual(pool.poolstats().poolsize,1)
-            self.assertEqual(pool.poolstats().poolused,1)
-            self.assertEqual(pool.poolstats().poolfree,0)
+            self.assertPoolStats(pool,size=1,used=1,free=0)
 
-  @unittest.mock.patch('nimue.nimue._NimueCleanupThread')
-  def testGetAtMaxZeroTimeout(self,FakeThread):
+  def testGetAtMaxZeroTimeout(self):
     """Test blocking getconnection when pool is at max size, with zero timeout"""
     x=[]
     with self.createpool(poolmin=1,poolmax=5,poolinit=5) as pool:
-      self.assertEqual(pool.poolstats().poolsize,5)
-      self.assertEqual(pool.poolstats().poolused,0)
-      self.assertEqual(pool.poolstats().poolfree,5)
+      self.assertPoolStats(pool,size=5,used=0,free=5)
       with contextlib.ExitStack() as stack:
         for i in range(0,5):
-          self.assertEqual(pool.poolstats().poolsize,5)
-          self.assertEqual(pool.poolstats().poolused,0+i)
-          self.assertEqual(pool.poolstats().poolfree,5-i)
-          x.append(pool.getconnection())
-          stack.push(contextlib.closing(x[-1]))
-        self.assertEqual(pool.poolstats().poolsize,5)
-        self.assertEqual(pool.poolstats().poolused,5)
-        self.assertEqual(pool.poolstats().poolfree,0)
+          self.assertPoolStats(pool,size=5,used=0+i,free=5-i)
+          x.append(stack.enter_context(contextlib.closing(pool.getconnection())))
+        self.assertPoolStats(pool,size=5,used=5,free=0)
         l=len(x)
         with self.assertRaises(nimue.error.NimueNoConnectionAvailable):
           x.append(pool.getconnection(timeout=0))
         if len(x) > l:
           stack.push(contextlib.closing(x[-1]))
         self.assertEqual(len(x),l)
-        self.assertEqual(pool.poolstats().poolsize,5)
-        self.assertEqual(pool.poolstats().poolused,5)
-        self.assertEqual(pool.poolstats().poolfree,0)
+        self.assertPoolStats(pool,size=5,used=5,free=0)
 
-  @unittest.mock.patch('nimue.nimue._NimueCleanupThread')
-  def testGetAtMaxNonZeroTimeout(self,FakeThread):
+  def testGetAtMaxNonZeroTimeout(self):
     """Test blocking getconnection when pool is at max size, with (small) non-zero timeout"""
     x=[]
     with self.createpool(poolmin=1,poolmax=5,poolinit=5) as pool:
-      self.assertEqual(pool.poolstats().poolsize,5)
-      self.assertEqual(pool.poolstats().poolused,0)
-      self.assertEqual(pool.poolstats().poolfree,5)
+      self.assertPoolStats(pool,size=5,used=0,free=5)
       with contextlib.ExitStack() as stack:
         for i in range(0,5):
-          self.assertEqual(pool.poolstats().poolsize,5)
-          self.assertEqual(pool.poolstats().poolused,0+i)
-          self.assertEqual(pool.poolstats().poolfree,5-i)
-          x.append(pool.getconnection())
-          stack.push(contextlib.closing(x[-1]))
-        self.assertEqual(pool.poolstats().poolsize,5)
-        self.assertEqual(pool.poolstats().poolused,5)
-        self.assertEqual(pool.poolstats().poolfree,0)
+          self.assertPoolStats(pool,size=5,used=0+i,free=5-i)
+          x.append(stack.enter_context(contextlib.closing(pool.getconnection())))
+        self.assertPoolStats(pool,size=5,used=5,free=0)
         l=len(x)
-        with self.assertRaises(nimue.error.NimueNoConnectionAvailable):
-          x.append(pool.getconnection(timeout=.25))
+        # have the wait time out straight away rather than sleeping for the full timeout
+        with unittest.mock.patch.object(nimue.nimue._NimueWaiter, 'wait', autospec=True, return_value=False) as mock_method:
+          with self.assertRaises(nimue.error.NimueNoConnectionAvailable):
+            x.append(pool.getconnection(timeout=.25))
         if len(x) > l:
           stack.push(contextlib.closing(x[-1]))
         self.assertEqual(len(x),l)
-        self.assertEqual(pool.poolstats().poolsize,5)
-        self.assertEqual(pool.poolstats().poolused,5)
-        self.assertEqual(pool.poolstats().poolfree,0)
-
-  @unittest.mock.patch('nimue.nimue._NimueCleanupThread')
-  def testGetAtMaxZeroTimeoutNonBlocking(self,FakeThread):
+        # the waiter was given what remained of the timeout
+        self.assertEqual(mock_method.call_count,1)
+        waittimeout=mock_method.call_args[0][1]
+        self.assertTrue(0 < waittimeout <= .25)
+        with pool._lock:
+          self.assertEqual(len(pool._waiters),0)
+        self.assertPoolStats(pool,size=5,used=5,free=0)
+
+  def testGetAtMaxZeroTimeoutNonBlocking(self):
     """Test non-blocking getconnection when pool is at max size"""
     x=[]
     with self.createpool(poolmin=1,poolmax=5,poolinit=5) as pool:
-      self.assertEqual(pool.poolstats().poolsize,5)
-      self.assertEqual(pool.poolstats().poolused,0)
-      self.assertEqual(pool.poolstats().poolfree,5)
+      self.assertPoolStats(pool,size=5,used=0,free=5)
       with contextlib.ExitStack() as stack:
         for i in range(0,5):
-          self.assertEqual(pool.poolstats().poolsize,5)
-          self.assertEqual(pool.poolstats().poolused,0+i)
-          self.assertEqual(pool.poolstats().poolfree,5-i)
-          x.append(pool.getconnection())
-          stack.push(contextlib.closing(x[-1]))
-        self.assertEqual(pool.poolstats().poolsize,5)
-        self.assertEqual(pool.poolstats().poolused,5)
-        self.assertEqual(pool.poolstats().poolfree,0)
+          self.assertPoolStats(pool,size=5,used=0+i,free=5-i)
+          x.append(stack.enter_context(contextlib.closing(pool.getconnection())))
+        self.assertPoolStats(pool,size=5,used=5,free=0)
         l=len(x)
         with self.assertRaises(nimue.error.NimueNoConnectionAvailable):
           x.append(pool.getconnection(blocking=False))
         if len(x) > l:
           stack.push(contextlib.closing(x[-1]))
         self.assertEqual(len(x),l)
-        self.assertEqual(pool.poolstats().poolsize,5)
-        self.assertEqual(pool.poolstats().poolused,5)
-        self.assertEqual(pool.poolstats().poolfree,0)
-
-  @unittest.mock.patch('nimue.nimue._NimueCleanupThread')
-  def testGetConnectionThreaded(self,FakeThread):
+        self.assertPoolStats(pool,size=5,used=5,free=0)
+
+  def testGetConnectionBadHealthcheckWakesWaiters(self):
+    """Test a connection failing its checkout healthcheck makes room for threads that queued during the check."""
+    checking=threading.Event()
+    finishcheck=threading.Event()
+    calls=[]
+    def healthcheck(conn,dbmodule):
+      calls.append(conn)
+      if len(calls) == 1:
+        checking.set()
+        finishcheck.wait(5)
+        return False
+      return True
+    result=[]
+    with self.createpool(poolmin=1,poolmax=1,healthcheck_callback=healthcheck) as pool:
+      t=[threading.Thread(target=self._checkoutthread,args=(pool,result))]
+      t[0].start()
+      self.assertTrue(checking.wait(5))
+      # queue a second thread up while the first one's healthcheck is running
+      t.append(threading.Thread(target=self._checkoutthread,args=(pool,result)))
+      t[1].start()
+      self.waitforwaiters(pool)
+      finishcheck.set()
+      for thread in t:
+        thread.join()
+      self.assertEqual(len(result),2)
+      self.assertPoolStats(pool,size=1,used=0,free=1)
+
+  def testGetConnectionHealthcheckRaises(self):
+    """Test a connection whose checkout healthcheck raises is removed from the pool."""
+    def healthcheck(conn,dbmodule):
+      raise ValueError("healthcheck failure")
+    with self.createpool(poolmin=2,poolmax=2,healthcheck_callback=healthcheck) as pool:
+      with self.assertRaises(ValueError):
+        pool.getconnection()
+      self.assertPoolStats(pool,size=1,used=0,free=1)
+
+  def testGetConnectionNewHealthcheckRaises(self):
+    """Test a new connection whose healthcheck raises is closed and replaced, like one failing the check."""
+    calls=[]
+    def healthcheck(conn,dbmodule):
+      calls.append(conn)
+      if len(calls) == 1:
+        raise ValueError("healthcheck failure")
+      return True
+    with self.createpool(poolmin=0,poolmax=1,poolinit=0,healthcheck_callback=healthcheck) as pool:
+      with unittest.mock.patch.object(nimue.nimue._NimueConnectionPoolMember, 'close', autospec=True, side_effect=Exception) as mock_method:
+        with contextlib.ExitStack() as stack:
+          logging.disable(level=logging.CRITICAL)
+          stack.callback(logging.disable,level=logging.NOTSET)
+          conn=pool.getconnection(timeout=5)
+        # the first connection was closed, and the error closing it was ignored
+        self.assertEqual(mock_method.call_count,1)
+      with contextlib.closing(conn):
+        self.assertEqual(len(calls),2)
+        self.assertIsNot(conn._conn,calls[0])
+        self.assertPoolStats(pool,size=1,used=1,free=0)
+
+  def testGetConnectionThreaded(self):
     """Test getconnection with multiple threads."""
-    def testthread(getevent,endevent,waitevent,pool):
-      #set event immediately before entering wait
-      waitevent.set()
-      with contextlib.closing(pool.getconnection()) as conn:
-        #set another event after getting connection
-        getevent.set()
+    def testthread(pool,gotconnection,endevent):
+      with contextlib.closing(pool.getconnection()):
+        gotconnection()
         endevent.wait()
 
     t=[]
-    with self.createpool(poolmin=1,poolmax=5,poolinit=1) as pool:
-      # launch 5 threads which will consume all connections in pool
-      for i in range(0,5):
-        t.append({'getevent': threading.Event(),'waitevent': threading.Event(),'endevent': threading.Event()})
-        t[-1]['thread']=threading.Thread(target=testthread,args=(t[-1]['getevent'],t[-1]['endevent'],t[-1]['waitevent'],pool))
-        t[-1]['thread'].start()
-      for i in range(0,5):
-        t[i]['getevent'].wait()
-      self.assertEqual(pool.poolstats().poolsize,5)
-      self.assertEqual(pool.poolstats().poolused,5)
-      self.assertEqual(pool.poolstats().poolfree,0)
-      # launch a sixth connection, which will be blocked waiting for a connection
-      t.append({'getevent': threading.Event(),'endevent': threading.Event(),'waitevent': threading.Event()})
-      t[5]['thread']=threading.Thread(target=testthread,args=(t[5]['getevent'],t[5]['endevent'],t[5]['waitevent'],pool))
-      t[5]['thread'].start()
-      # possible non-determinism here - we can't know absolutely for
-      # sure that the thread is blocked waiting.  But if waitevent is
-      # set, that happens right before it calls getconnection, and if
-      # getevent is not set, that means the connection hasn't been
-      # obtained. So *probably* the thread is waiting.
-      # We can at least verify that the poolstats haven't changed.
-      t[5]['waitevent'].wait()
-      self.assertEqual(pool.poolstats().poolsize,5)
-      self.assertEqual(pool.poolstats().poolused,5)
-      self.assertEqual(pool.poolstats().poolfree,0)
-      self.assertFalse(t[5]['getevent'].isSet())
-
-      # Finish out the first thread
-      t[0]['endevent'].set()
-      t[0]['thread'].join()
-      # Now wait for the final thread to obtain its connection
-      self.assertTrue(t[5]['getevent'].wait())
-      self.assertEqual(pool.poolstats().poolsize,5)
-      self.assertEqual(pool.poolstats().poolused,5)
-      self.assertEqual(pool.poolstats().poolfree,0)
-
-      # Now finish out remaining threads
-      for i in range(1,6):
-        t[i]['endevent'].set()
-        t[i]['thread'].join()
-
-      # Make sure the pool looks like we expect
-      self.assertEqual(pool.poolstats().poolsize,5)
-      self.assertEqual(pool.poolstats().poolused,0)
-      self.assertEqual(pool.poolstats().poolfree,5)
-
-class ConnectionTests(unittest.TestCase):
-  @unittest.mock.patch('nimue.nimue._NimueCleanupThread')
-  def setUp(self,FakeThread):
-    def createpool(**kwargs):
-      createpoolkwargs=poolkwargs.copy()
-      createpoolkwargs.update(kwargs)
-      return nimue.NimueConnectionPool(connfunc,connargs,connkwargs,**createpoolkwargs)
-    self.createpool=createpool
+    endevents=[threading.Event() for i in range(0,6)]
+    # the five threads filling the pool and the main thread meet here once all connections are taken
+    barrier=threading.Barrier(6,timeout=5)
+    getevent=threading.Event()
+    pool=self.createpool(poolmin=1,poolmax=5,poolinit=1)
+    self.addCleanup(pool.close)
+    # cleanups run in reverse, so on a failed assertion the threads are released and joined before the pool closes
+    def finishthreads():
+      for endevent in endevents:
+        endevent.set()
+      for thread in t:
+        thread.join()
+    self.addCleanup(finishthreads)
+    # launch 5 threads which will consume all connections in pool
+    for i in range(0,5):
+      t.append(threading.Thread(target=testthread,args=(pool,barrier.wait,endevents[i])))
+      t[-1].start()
+    barrier.wait()
+    self.assertPoolStats(pool,size=5,used=5,free=0)
+    # launch a sixth thread, which will be blocked waiting for a connection
+    t.append(threading.Thread(target=testthread,args=(pool,getevent.set,endevents[5])))
+    t[5].start()
+    self.waitforwaiters(pool)
+    self.assertPoolStats(pool,size=5,used=5,free=0)
+    self.assertFalse(getevent.is_set())
+
+    # Finish out the first thread
+    endevents[0].set()
+    t[0].join()
+    # Now wait for the final thread to obtain its connection
+    self.assertTrue(getevent.wait(5))
+    self.assertPoolStats(pool,size=5,used=5,free=0)
+
+    # Now finish out remaining threads
+    for i in range(1,6):
+      endevents[i].set()
+      t[i].join()
+
+    # Make sure the pool looks like we expect
+    self.assertPoolStats(pool,size=5,used=0,free=5)
+
+  def testGetConnectionHandoff(self):
+    """Test that a returned connection is handed directly to a waiting thread."""
+    result=[]
+    with self.createpool(poolmin=1,poolmax=1,poolinit=1) as pool:
+      conn=pool.getconnection()
+      member=conn._member
+      t=threading.Thread(target=self._checkoutthread,args=(pool,result))
+      t.start()
+      self.waitforwaiters(pool)
+      with pool._lock:
+        conn.close()
+        # the connection went straight to the waiter, not the free list
+        self.assertEqual(len(pool._waiters),0)
+        self.assertEqual(len(pool._free),0)
+      t.join()
+      self.assertEqual(result,[member])
+      self.assertPoolStats(pool,size=1,used=0,free=1)
+
+  def testGetConnectionWaitInterrupted(self):
+    """Test a waiter interrupted by an exception doesn't stay queued or keep a connection handed to it."""
+    with self.createpool(poolmin=1,poolmax=1,poolinit=1) as pool:
+      conn=pool.getconnection()
+      with unittest.mock.patch.object(nimue.nimue._NimueWaiter, 'wait', autospec=True, side_effect=KeyboardInterrupt):
+        with self.assertRaises(KeyboardInterrupt):
+          pool.getconnection(timeout=5)
+      with pool._lock:
+        self.assertEqual(len(pool._waiters),0)
+
+      # the connection is handed over before the interruption lands
+      def wait(waiter,timeout):
+        conn.close()
+        raise KeyboardInterrupt
+      with unittest.mock.patch.object(nimue.nimue._NimueWaiter, 'wait', autospec=True, side_effect=wait):
+        with self.assertRaises(KeyboardInterrupt):
+          pool.getconnection(timeout=5)
+      self.assertPoolStats(pool,size=1,used=0,free=1)
+
+  def testGetConnectionWaitersFirst(self):
+    """Test that waiting threads are served before new callers when room is made in the pool."""
+    result=[]
+    with self.createpool(poolmin=1,poolmax=1,poolinit=1) as pool:
+      with contextlib.closing(pool.getconnection()) as conn:
+        t=threading.Thread(target=self._checkoutthread,args=(pool,result))
+        t.start()
+        self.waitforwaiters(pool)
+        with pool._lock:
+          pool.poolmax=2
+          # raising poolmax woke the waiter to add a connection
+          self.assertEqual(len(pool._waiters),0)
+        t.join()
+        self.assertEqual(len(result),1)
+        self.assertNotEqual(result[0],conn._member)
+        self.assertPoolStats(pool,size=2,used=1,free=1)
+
+  def testWakeWaitersReservesSlots(self):
+    """Test waiters woken for room in the pool keep their slot, so the pool never grows past poolmax."""
+    def testthread(pool,result,endevent):
+      with contextlib.closing(pool.getconnection(timeout=10)) as conn:
+        result.append(conn._member)
+        endevent.wait(10)
+
+    result=[]
+    endevent=threading.Event()
+    t=[]
+    with self.createpool(poolmin=1,poolmax=1,poolinit=1) as pool:
+      with contextlib.closing(pool.getconnection()):
+        for i in range(0,2):
+          t.append(threading.Thread(target=testthread,args=(pool,result,endevent)))
+          t[-1].start()
+        self.addCleanup(lambda: [thread.join() for thread in t])
+        self.addCleanup(endevent.set)
+        self.waitforwaiters(pool,count=2)
+        with pool._lock:
+          # there's room for one more connection, however many times waiters are woken
+          pool.poolmax=2
+          pool.poolmax=2
+          self.assertEqual(len(pool._waiters),1)
+          # and a new caller can't take the slot before the woken thread gets to it
+          with self.assertRaises(nimue.error.NimueNoConnectionAvailable):
+            pool.getconnection(blocking=False)
+        deadline=time.monotonic()+5
+        while len(result) < 1:
+          self.assertLess(time.monotonic(),deadline)
+          time.sleep(.01)
+        self.assertEqual(pool.poolstats().poolsize,2)
+      # returning our connection serves the other waiter
+      deadline=time.monotonic()+5
+      while len(result) < 2:
+        self.assertLess(time.monotonic(),deadline)
+        time.sleep(.01)
+      self.assertPoolStats(pool,size=2,used=2)
+      endevent.set()
+      for thread in t:
+        thread.join()
+      self.assertPoolStats(pool,size=2,free=2)
+
+class ConnectionTests(NimueTestCase):
+  def setUp(self):
+    super().setUp()
 
-    self.pool=createpool(poolmin=2,poolmax=10)
+    self.pool=self.createpool(poolmin=2,poolmax=10)
+    self.addCleanup(self.pool.close)
 
   def testClose(self):
     """Test connection close returns connection to pool free list."""
@@ -562,8 +874,34 @@ class ConnectionTests(unittest.TestCase):
       pass
     self.assertEqual(self.pool.poolstats().poolfree,2)
 
-  @unittest.mock.patch('nimue.nimue._NimueCleanupThread')
-  def testCloseWithClosedPool(self,FakeThread):
+  def testAttributeForwarding(self):
+    """Test attribute access on a connection is forwarded to the underlying connection."""
+    with contextlib.closing(self.pool.getconnection()) as conn:
+      with contextlib.closing(conn.cursor()) as curs:
+        if notaballowed:
+          curs.execute("SELECT 1")
+        else:
+          curs.execute("SELECT 1 FROM DUAL")
+        self.assertEqual(curs.fetchall()[0][0],1)
+      conn.rollback()
+      conn.commit()
+      with self.assertRaises(AttributeError):
+        conn.nimue_missing_attr
+
+    # attributes not defined on the wrapper are written to and read from the underlying connection
+    conn=nimue.NimueConnection(self.pool,unittest.mock.Mock())
+    conn.nimue_test_attr=1
+    self.assertEqual(conn._conn.nimue_test_attr,1)
+    self.assertEqual(conn.nimue_test_attr,1)
+    # never checked out of the pool, so don't try to return it
+    conn._closed=True
+
+  def testWeakref(self):
+    """Test connections can be weakly referenced."""
+    with contextlib.closing(self.pool.getconnection()) as conn:
+      self.assertIs(weakref.ref(conn)(),conn)
+
+  def testCloseWithClosedPool(self):
     """Test connection close when pool is already closed."""
     pool=self.createpool(poolmin=1,poolmax=5,poolinit=5)
     conn=pool.getconnection()
@@ -581,19 +919,8 @@ class ConnectionTests(unittest.TestCase):
     conn.close()
     pool.close()
 
-  def tearDown(self):
-    self.pool.close()
-
-class CallbackTests(unittest.TestCase):
-  def setUp(self):
-    def createpool(**kwargs):
-      createpoolkwargs=poolkwargs.copy()
-      createpoolkwargs.update(kwargs)
-      return nimue.NimueConnectionPool(connfunc,connargs,connkwargs,**createpoolkwargs)
-    self.createpool=createpool
-
-  @unittest.mock.patch('nimue.nimue._NimueCleanupThread')
-  def testStdHealthcheck(self,FakeThread):
+class CallbackTests(NimueTestCase):
+  def testStdHealthcheck(self):
     """Test healthcheck_callback_std"""
     with self.createpool(poolmin=1,poolmax=5,poolinit=5,healthcheck_callback=nimue.callback.healthcheck_callback_std) as pool:
       # Jump through some hoops here to accomadate databases that can't handle the standard healthcheck
@@ -610,8 +937,7 @@ class CallbackTests(unittest.TestCase):
         r=conn._member.healthcheck()
         self.assertTrue(r)
 
-  @unittest.mock.patch('nimue.nimue._NimueCleanupThread')
-  def testOracleHealthcheck(self,FakeThread):
+  def testOracleHealthcheck(self):
     """Test healthcheck_callback_oracle"""
     with self.createpool(poolmin=1,poolmax=5,poolinit=5,healthcheck_on_getconnection=False,healthcheck_callback=nimue.callback.healthcheck_callback_oracle) as pool:
       with contextlib.closing(pool.getconnection()) as conn:
@@ -625,8 +951,39 @@ class CallbackTests(unittest.TestCase):
             self.assertFalse(r)
         conn.rollback()
 
-  @unittest.mock.patch('nimue.nimue._NimueCleanupThread')
-  def testRollbackAutocommit(self,FakeThread):
+  def testPingHealthcheck(self):
+    """Test healthcheck_callback_ping"""
+    class DBError(Exception):
+      pass
+    dbmodule=unittest.mock.Mock(Error=DBError)
+    conn=unittest.mock.Mock()
+    self.assertTrue(nimue.callback.healthcheck_callback_ping(conn,dbmodule))
+    self.assertTrue(conn.ping.called)
+    conn.ping.side_effect=DBError()
+    self.assertFalse(nimue.callback.healthcheck_callback_ping(conn,dbmodule))
+    conn.ping.side_effect=ValueError()
+    with contextlib.ExitStack() as stack:
+      logging.disable(level=logging.CRITICAL)
+      stack.callback(logging.disable,level=logging.NOTSET)
+      self.assertFalse(nimue.callback.healthcheck_callback_ping(conn,dbmodule))
+
+  def testMadeHealthcheck(self):
+    """Test make_healthcheck_callback"""
+    query="SELECT 1" if notaballowed else "SELECT 1 FROM DUAL"
+    with self.createpool(poolmin=1,poolmax=5,poolinit=5,healthcheck_on_getconnection=False,healthcheck_callback=nimue.callback.make_healthcheck_callback(query)) as pool:
+      with contextlib.closing(pool.getconnection()) as conn:
+        r=conn._member.healthcheck()
+        self.assertTrue(r)
+    with self.createpool(poolmin=1,poolmax=5,poolinit=5,healthcheck_on_getconnection=False,healthcheck_callback=nimue.callback.make_healthcheck_callback("SELECT * FROM nonexistent_table")) as pool:
+      with contextlib.closing(pool.getconnection()) as conn:
+        with contextlib.ExitStack() as stack:
+          logging.disable(level=logging.CRITICAL)
+          stack.callback(logging.disable,level=logging.NOTSET)
+          r=conn._member.healthcheck()
+          self.assertFalse(r)
+        conn.rollback()
+
+  def testRollbackAutocommit(self):
     """Test behavior of healthcheck when autocommit is disabled."""
     with self.createpool(poolmin=1,poolmax=5,poolinit=5) as pool:
       with contextlib.closing(pool.getconnection()) as conn:
@@ -635,5 +992,8 @@ class CallbackTests(unittest.TestCase):
         self.assertTrue(r)
 
 if __name__=='__main__':
-  unittest.main()
-  final_cleanup()
+  # unittest.main() exits via SystemExit, so clean up on the way out
+  try:
+    unittest.main()
+  finally:
+    final_cleanup()